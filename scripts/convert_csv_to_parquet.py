@@ -0,0 +1,87 @@
+"""One-shot conversion of the raw CSV inputs into typed, ZSTD-compressed Parquet.
+
+Run from the repository root whenever the files under ./data/csv change:
+
+    python scripts/convert_csv_to_parquet.py
+"""
+
+from pathlib import Path
+
+import duckdb
+
+CSV_DIR = Path("./data/csv")
+PARQUET_DIR = Path("./data/parquet")
+
+# output name -> SELECT over the raw csv, casting columns to their real types
+# and deriving join keys once; the HPI series are sorted by year so the
+# parquet row-group statistics can skip years outside the queried window
+CONVERSIONS = {
+    "hpi_tract": """
+        SELECT
+            tract,
+            state_abbr,
+            TRY_CAST(year AS INTEGER) AS year,
+            TRY_CAST(annual_change AS FLOAT) AS annual_change,
+            TRY_CAST(hpi AS FLOAT) AS hpi,
+            TRY_CAST(hpi1990 AS FLOAT) AS hpi1990,
+            TRY_CAST(hpi2000 AS FLOAT) AS hpi2000,
+            left(tract, 5) AS fips
+        FROM read_csv('{csv_dir}/hpi_at_bdl_tract.csv', nullstr='.')
+        ORDER BY year, tract
+    """,
+    "hpi_zip": """
+        SELECT
+            "Five-Digit ZIP Code",
+            TRY_CAST(Year AS INTEGER) AS Year,
+            TRY_CAST("Annual Change (%)" AS FLOAT) AS "Annual Change (%)",
+            TRY_CAST(HPI AS FLOAT) AS HPI,
+            TRY_CAST("HPI with 1990 base" AS FLOAT) AS "HPI with 1990 base",
+            TRY_CAST("HPI with 2000 base" AS FLOAT) AS "HPI with 2000 base"
+        FROM read_csv('{csv_dir}/hpi_zip5.csv', nullstr='.')
+        ORDER BY Year, "Five-Digit ZIP Code"
+    """,
+    "zip_cbsa": """
+        SELECT * REPLACE (TRY_CAST(CBSA AS INTEGER) AS CBSA)
+        FROM read_csv('{csv_dir}/us_zip5_cbsa.csv', nullstr='.')
+    """,
+    "zip_attr": """
+        SELECT * REPLACE (
+            TRY_CAST(population AS INTEGER) AS population,
+            TRY_CAST(density AS FLOAT) AS density
+        )
+        FROM read_csv('{csv_dir}/us_zip5_attr.csv', nullstr='.')
+    """,
+    "zip_pop": """
+        SELECT * REPLACE (
+            lpad(zip::VARCHAR, 5, '0') AS zip,
+            TRY_CAST(population AS INTEGER) AS population
+        )
+        FROM read_csv('{csv_dir}/us_zip5_population.csv', nullstr='.')
+    """,
+    "fips_cbsa": """
+        SELECT
+            * REPLACE (TRY_CAST(cbsacode AS INTEGER) AS cbsacode),
+            (fipsstatecode || fipscountycode) AS fips
+        FROM read_csv('{csv_dir}/us_fips_cbsa.csv', nullstr='.')
+    """,
+    "cbsa": """
+        SELECT * REPLACE (TRY_CAST("CBSA Code" AS INTEGER) AS "CBSA Code")
+        FROM read_csv('{csv_dir}/us_cbsas.csv', nullstr='.')
+    """,
+}
+
+
+def main():
+    PARQUET_DIR.mkdir(parents=True, exist_ok=True)
+    con = duckdb.connect(database=":memory:")
+    for name, select in CONVERSIONS.items():
+        out_path = PARQUET_DIR / f"{name}.parquet"
+        con.execute(
+            f"""COPY ({select.format(csv_dir=CSV_DIR.as_posix())})
+            TO '{out_path.as_posix()}' (FORMAT PARQUET, COMPRESSION ZSTD)"""
+        )
+        print(f"wrote {out_path}")
+
+
+if __name__ == "__main__":
+    main()
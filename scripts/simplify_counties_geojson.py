@@ -0,0 +1,64 @@
+"""One-shot shrinking of the counties GeoJSON used by the map.
+
+Truncates coordinates to 4 decimals (~11 m), which is invisible at the
+app's default zoom, and repairs the few rings that rounding makes cross
+themselves. Vertices are otherwise left alone: simplifying each county on its
+own would move the borders it shares with its neighbours independently and
+open gaps between them, so any vertex reduction belongs in a topology-aware
+tool that simplifies shared edges once. Run from the repository root:
+
+    python scripts/simplify_counties_geojson.py
+"""
+
+import json
+from pathlib import Path
+
+from shapely import make_valid
+from shapely.geometry import MultiPolygon, Polygon, mapping, shape
+
+SRC = Path("./data/json/geojson-counties-fips.json")
+DST = Path("./data/json/geojson-counties-fips.min.json")
+
+PRECISION = 4
+
+
+def _round_coords(coords):
+    if isinstance(coords[0], (int, float)):
+        return [round(c, PRECISION) for c in coords]
+    return [_round_coords(c) for c in coords]
+
+
+def _polygonal(geom):
+    # make_valid can return a GeometryCollection with stray lines or points
+    polys = []
+    for part in getattr(geom, "geoms", [geom]):
+        if isinstance(part, Polygon):
+            polys.append(part)
+        elif isinstance(part, MultiPolygon):
+            polys.extend(part.geoms)
+    return polys[0] if len(polys) == 1 else MultiPolygon(polys)
+
+
+def round_feature(feature):
+    geometry = dict(feature["geometry"])
+    geometry["coordinates"] = _round_coords(geometry["coordinates"])
+    rounded = shape(geometry)
+    # snapping near-coincident vertices can make a ring cross itself; repair
+    # in place, which only adds nodes where edges cross and keeps every
+    # rounded vertex, so borders shared with neighbours still line up
+    if not rounded.is_valid:
+        geometry = json.loads(json.dumps(mapping(_polygonal(make_valid(rounded)))))
+    return {**feature, "geometry": geometry}
+
+
+def main():
+    with open(SRC, "r", encoding="utf8") as f:
+        counties = json.load(f)
+    counties["features"] = [round_feature(f) for f in counties["features"]]
+    with open(DST, "w", encoding="utf8") as f:
+        json.dump(counties, f, separators=(",", ":"))
+    print(f"wrote {DST} ({SRC.stat().st_size:,} -> {DST.stat().st_size:,} bytes)")
+
+
+if __name__ == "__main__":
+    main()
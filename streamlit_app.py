@@ -1,10 +1,13 @@
+import os
+
 import streamlit as st
 import duckdb
 import pandas as pd
+import pyarrow as pa
 import numpy as np
-from plotly.express import choropleth_mapbox
 import plotly.express as px
-import json
+import plotly.graph_objects as go
+import orjson
 
 st.set_page_config(layout="wide")
 
@@ -12,57 +15,294 @@ st.set_page_config(layout="wide")
 if "selected_cbsa" not in st.session_state:
     st.session_state.selected_cbsa = None
 
-# create an in-memory database
-con = duckdb.connect(database=":memory:")
-
-# load data into the database
-con.execute(
-    """CREATE OR REPLACE TABLE hpi_tract AS 
-    SELECT *,
-    left(tract, 5) as fips
-    FROM read_csv('./data/csv/hpi_at_bdl_tract.csv', nullstr='.')"""
-)
-con.execute(
-    """CREATE OR REPLACE TABLE hpi_zip 
-    AS SELECT *
-    FROM read_csv('./data/csv/hpi_zip5.csv', nullstr='.')"""
-)
-con.execute(
-    """CREATE OR REPLACE TABLE zip_cbsa AS SELECT *
-    FROM read_csv('./data/csv/us_zip5_cbsa.csv', nullstr='.')"""
-)
-con.execute(
-    """CREATE OR REPLACE TABLE zip_attr AS
-    SELECT * FROM read_csv('./data/csv/us_zip5_attr.csv', nullstr='.')"""
-)
-con.execute(
-    """CREATE OR REPLACE TABLE zip_pop AS SELECT *
-    FROM read_csv('./data/csv/us_zip5_population.csv', nullstr='.')"""
-)
-con.execute(
-    """CREATE OR REPLACE TABLE fips_cbsa AS SELECT *,
-    (fipsstatecode || fipscountycode) as fips
-    FROM read_csv('./data/csv/us_fips_cbsa.csv', nullstr='.')"""
-)
-con.execute(
-    """CREATE TABLE cbsa AS SELECT * 
-    FROM read_csv('./data/csv/us_cbsas.csv', nullstr='.')"""
-)
-
-with open("./data/json/geojson-counties-fips.json", "r", encoding="utf8") as f:
-    geojson_counties = json.load(f)
+
+@st.cache_resource
+def get_con():
+    # create an in-memory database, shared by every session in this process
+    c = duckdb.connect(database=":memory:")
+    c.execute(f"PRAGMA threads={os.cpu_count() or 1}")
+
+    # load data into the database; the parquet files are produced from
+    # ./data/csv by scripts/convert_csv_to_parquet.py
+    c.execute(
+        """CREATE OR REPLACE VIEW hpi_tract AS
+        SELECT *
+        FROM read_parquet('./data/parquet/hpi_tract.parquet')"""
+    )
+    c.execute(
+        """CREATE OR REPLACE VIEW hpi_zip
+        AS SELECT *
+        FROM read_parquet('./data/parquet/hpi_zip.parquet')"""
+    )
+    c.execute(
+        """CREATE OR REPLACE VIEW zip_cbsa AS SELECT *
+        FROM read_parquet('./data/parquet/zip_cbsa.parquet')"""
+    )
+    c.execute(
+        """CREATE OR REPLACE VIEW zip_attr AS
+        SELECT * FROM read_parquet('./data/parquet/zip_attr.parquet')"""
+    )
+    c.execute(
+        """CREATE OR REPLACE VIEW zip_pop AS SELECT *
+        FROM read_parquet('./data/parquet/zip_pop.parquet')"""
+    )
+    c.execute(
+        """CREATE OR REPLACE VIEW fips_cbsa AS SELECT *
+        FROM read_parquet('./data/parquet/fips_cbsa.parquet')"""
+    )
+    c.execute(
+        """CREATE OR REPLACE VIEW cbsa AS SELECT *
+        FROM read_parquet('./data/parquet/cbsa.parquet')"""
+    )
+
+    # precompute the per-tract and per-year aggregates once so that each CBSA
+    # selection only has to filter these small tables
+    c.execute(
+        """CREATE OR REPLACE TABLE hpi_tract_agg AS
+        with county_attr as (
+            SELECT
+                county_fips as fips,
+                avg(lat) as latitude,
+                avg(lng) as longitude,
+                sum(distinct population)::BIGINT as population
+            FROM zip_attr
+            GROUP BY 1
+        ),
+        hpi_per_tract as (
+            SELECT
+                cbsa."CBSA Name" as cbsa_name,
+                hpi.fips as fips,
+                min(hpi.HPI) as min_hpi,
+                max(hpi.HPI) as max_hpi,
+                -- year of the extremum in a single pass; ties go to the earliest year
+                arg_min(hpi.YEAR, (hpi.HPI, hpi.YEAR)) as min_year,
+                arg_max(hpi.YEAR, (hpi.HPI, -hpi.YEAR)) as max_year
+            FROM hpi_tract hpi
+            join fips_cbsa on hpi.fips = fips_cbsa.fips
+            join cbsa on fips_cbsa.cbsacode = cbsa."CBSA Code"
+            WHERE hpi.YEAR BETWEEN 2005 AND 2013
+            AND hpi.HPI > 0
+            GROUP BY 1,2
+        )
+        select
+            hpi_per_tract.cbsa_name,
+            hpi_per_tract.fips,
+            county_attr.latitude,
+            county_attr.longitude,
+            county_attr.population,
+            hpi_per_tract.min_hpi,
+            hpi_per_tract.max_hpi,
+            hpi_per_tract.min_year,
+            hpi_per_tract.max_year,
+            (min_hpi/max_hpi - 1) as hpi_loss
+        from hpi_per_tract
+        left join county_attr on hpi_per_tract.fips = county_attr.fips
+        order by hpi_per_tract.cbsa_name, hpi_per_tract.fips"""
+    )
+    c.execute(
+        """CREATE OR REPLACE TABLE hpi_cbsa_year AS
+        SELECT cbsa."CBSA Name" as cbsa_name, hpi.YEAR as year, AVG(hpi.HPI) as avg_hpi
+        FROM hpi_zip hpi
+        JOIN zip_cbsa ON hpi."Five-Digit ZIP Code" = zip_cbsa.ZIP
+        JOIN cbsa ON zip_cbsa.CBSA = cbsa."CBSA Code"
+        WHERE hpi.YEAR BETWEEN 2005 AND 2013
+        AND hpi.HPI > 0
+        GROUP BY 1,2
+        ORDER BY 1,2"""
+    )
+    return c
+
+
+con = get_con()
+
+
+@st.cache_resource
+def load_counties():
+    with open("./data/json/geojson-counties-fips.min.json", "rb") as f:
+        return orjson.loads(f.read())
+
+
+@st.cache_data
+def subset_geojson(fips):
+    # only ship the counties that are actually drawn to the browser
+    wanted = set(fips)
+    return {
+        "type": "FeatureCollection",
+        "features": [f for f in load_counties()["features"] if f["id"] in wanted],
+    }
 
 
 @st.cache_data(ttl=600)
-def run_query(query):
+def run_query(query, params=()):
     try:
-        df_raw = con.sql(query).df()
+        # the connection is shared across sessions; give each call its own cursor
+        with con.cursor() as cur:
+            tbl = cur.execute(query, params).fetch_arrow_table()
+        # keep strings in arrow buffers rather than materializing python objects
+        df_raw = tbl.to_pandas(types_mapper=pd.ArrowDtype)
         return df_raw
     except Exception as e:
         st.error(f"Error running query: {e}")
         return pd.DataFrame()
 
 
+@st.cache_data(ttl=600)
+def load_cbsa(cbsa_name):
+    # scan hpi_tract_agg once for the CBSA, then summarise that arrow subset
+    # for the map center and key statistics instead of filtering again
+    try:
+        with con.cursor() as cur:
+            tbl = cur.execute(
+                "SELECT * FROM hpi_tract_agg WHERE cbsa_name = ?", (cbsa_name,)
+            ).fetch_arrow_table()
+            cur.register("cbsa_tracts", tbl)
+            stats = cur.execute("""
+                SELECT
+                    AVG(latitude),
+                    AVG(longitude),
+                    COALESCE(SUM(population), 0),
+                    AVG(hpi_loss),
+                    MIN(min_year),
+                    MAX(max_year)
+                FROM cbsa_tracts
+                """).fetchone()
+        # fips repeats across the map's groupby, so key it on small integer
+        # codes, and right-size the numeric columns that st.dataframe sends
+        # to the browser
+        cbsa_df = tbl.to_pandas(types_mapper=pd.ArrowDtype).astype(
+            {
+                "fips": "category",
+                "latitude": "float32",
+                "longitude": "float32",
+                # nullable: tracts without zip attributes have no population
+                "population": pd.ArrowDtype(pa.int32()),
+            }
+        )
+        return cbsa_df, stats
+    except Exception as e:
+        st.error(f"Error running query: {e}")
+        return pd.DataFrame(), None
+
+
+# the figures are keyed on the CBSA alone, so flipping back to a previously
+# selected CBSA reuses the built figure instead of rebuilding it
+@st.cache_data(ttl=600)
+def get_line_fig(cbsa_name):
+    # average of HPI across all fips by year
+    hpi_by_year = run_query(
+        """
+        SELECT year, avg_hpi
+        FROM hpi_cbsa_year
+        WHERE cbsa_name = ?
+        ORDER BY year
+        """,
+        params=(cbsa_name,),
+    )
+    if hpi_by_year.empty:
+        return None
+
+    # Find the maximum and minimum points
+    vals = hpi_by_year["avg_hpi"].to_numpy()
+    years = hpi_by_year["year"].to_numpy()
+    imax = vals.argmax()
+    imin = vals.argmin()
+    y_max_v, y_min_v = vals[imax], vals[imin]
+    yr_max = years[imax]
+
+    # Calculate y-axis range
+    y_min = y_min_v * 0.95  # 5% below the minimum value
+    y_max = y_max_v * 1.05  # 5% above the maximum value
+
+    # Calculate percentage loss
+    percent_loss = (y_min_v - y_max_v) / y_max_v * 100
+
+    # Create the line chart using Plotly
+    fig = px.line(
+        hpi_by_year,
+        x="year",
+        y="avg_hpi",
+        title=f"Average HPI for {cbsa_name}",
+    )
+
+    # Add vertical line and annotation
+    fig.add_shape(
+        type="line",
+        x0=yr_max,
+        y0=y_max_v,
+        x1=yr_max,
+        y1=y_min_v,
+        line=dict(color="red", width=2, dash="dash"),
+    )
+
+    fig.add_annotation(
+        x=yr_max,
+        y=y_min_v,  # Position at the bottom of the line
+        text=f"{percent_loss:.1f}% loss",
+        showarrow=True,
+        arrowhead=2,
+        arrowsize=1,
+        arrowwidth=2,
+        arrowcolor="red",
+        ax=40,
+        ay=-40,  # Adjust this value to move the annotation up or down
+        yanchor="top",  # Anchor the text to the top so it appears below the arrow
+    )
+
+    # Update the layout to set the y-axis range
+    fig.update_layout(
+        yaxis_range=[y_min, y_max],
+        xaxis_title="Year",
+        yaxis_title="Average HPI",
+    )
+    return fig
+
+
+@st.cache_data(ttl=600)
+def get_map_fig(cbsa_name):
+    # loss from HPI Max to HPI Min for each fips, centered on the CBSA
+    map_df, (center_lat, center_lon, *_) = load_cbsa(cbsa_name)
+    fig = go.Figure(
+        go.Choroplethmapbox(
+            geojson=subset_geojson(tuple(map_df["fips"])),
+            locations=map_df["fips"],
+            # 0.1% steps are finer than the color scale can show
+            z=map_df["hpi_loss"].round(3),
+            colorscale="RdYlGn",
+            zmin=-0.5,  # Adjust this range based on your data
+            zmax=0,
+            marker_opacity=0.7,
+            colorbar_title="HPI Loss",
+            hovertemplate="fips=%{location}<br>HPI Loss=%{z}<extra></extra>",
+        )
+    )
+    fig.update_layout(
+        margin={"r": 0, "t": 0, "l": 0, "b": 0},
+        mapbox=dict(
+            style="carto-positron",
+            bearing=0,
+            center=dict(lat=center_lat, lon=center_lon),
+            pitch=0,
+            zoom=7,  # Increased from 2 to 7 for a closer default zoom
+        ),
+    )
+    return fig
+
+
+@st.cache_data
+def cbsa_names():
+    # sorted by population descending
+    with con.cursor() as cur:
+        rows = cur.execute("""
+            SELECT c."CBSA Name" as cbsa_name
+            FROM cbsa c
+            JOIN zip_cbsa zc ON c."CBSA Code" = zc.CBSA
+            JOIN zip_pop zp ON zc.ZIP = zp.ZIP
+            GROUP BY c."CBSA Name"
+            ORDER BY SUM(zp.POPULATION) DESC
+            """).fetchall()
+    return tuple(r[0] for r in rows)
+
+
 # Display data
 # st.write(con.sql("SELECT * FROM hpi LIMIT 10"))
 # st.write(con.sql("SELECT * FROM cbsa LIMIT 10"))
@@ -84,18 +324,9 @@ if not st.session_state.selected_cbsa:
 # Sidebar
 with st.sidebar:
     previous_selection = st.session_state.selected_cbsa
-    # sorted by population descending
-    cbsa_options = run_query("""
-                             SELECT DISTINCT c."CBSA Name" as cbsa_name 
-                             FROM cbsa c
-                             JOIN zip_cbsa zc ON c."CBSA Code" = zc.CBSA
-                             JOIN zip_pop zp ON zc.ZIP = zp.ZIP
-                             GROUP BY c."CBSA Name"
-                             ORDER BY SUM(TRY_CAST(zp.POPULATION AS INTEGER)) DESC
-                             """)
     selected_cbsa = st.selectbox(
         "Select a CBSA",
-        cbsa_options,
+        cbsa_names(),
     )
 
     # Update session state
@@ -103,39 +334,10 @@ with st.sidebar:
         st.session_state.selected_cbsa = selected_cbsa
         # st.write(f"Debug: CBSA selection changed to {selected_cbsa}")
 
-    out_df = run_query(
-        f"""
-        with hpi_per_tract as (
-            SELECT
-                cbsa."CBSA Name" as cbsa_name, 
-                hpi.fips as fips,
-                avg(zip_attr.lat) as latitude,
-                avg(zip_attr.lng) as longitude,
-                sum(distinct TRY_CAST(zip_attr.population AS INTEGER)) as population,
-                min(TRY_CAST(hpi.HPI AS FLOAT)) as min_hpi, 
-                max(TRY_CAST(hpi.HPI AS FLOAT)) as max_hpi
-            FROM hpi_tract hpi
-            left join fips_cbsa on hpi.fips = fips_cbsa.fips
-            left join zip_attr on hpi.fips = zip_attr.county_fips
-            left join cbsa on fips_cbsa.cbsacode = cbsa."CBSA Code"
-            WHERE 1=1
-            AND cbsa."CBSA Name" ILIKE '{st.session_state.selected_cbsa}'
-            AND TRY_CAST(hpi.YEAR AS INTEGER) BETWEEN 2005 AND 2013
-            AND TRY_CAST(hpi.HPI AS FLOAT) > 0
-            GROUP BY 1,2
-            )
-            select 
-                hpi_per_tract.*,
-                hmin.YEAR as min_year,
-                hmax.YEAR as max_year,
-                (min_hpi/max_hpi - 1) as hpi_loss
-            from hpi_per_tract
-            left join hpi_tract hmin on hpi_per_tract.fips = hmin.fips 
-                and TRY_CAST(hmin.HPI AS FLOAT) = hpi_per_tract.min_hpi
-            left join hpi_tract hmax on hpi_per_tract.fips = hmax.fips 
-                and TRY_CAST(hmax.HPI AS FLOAT) = hpi_per_tract.max_hpi
-            """
-    )
+    out_df, cbsa_stats = load_cbsa(st.session_state.selected_cbsa)
+    if cbsa_stats is None:
+        # load_cbsa has already reported the error
+        st.stop()
 
 
 # Main Content
@@ -149,124 +351,46 @@ with st.container():
             st.dataframe(out_df)
 
             # output a line chart showing average of HPI across all fips by year
-            hpi_by_year = run_query(f"""
-                SELECT YEAR::int as year, AVG(TRY_CAST(HPI AS FLOAT)) as avg_hpi
-                FROM hpi_zip hpi
-                JOIN zip_cbsa ON hpi."Five-Digit ZIP Code" = zip_cbsa.ZIP
-                JOIN cbsa ON zip_cbsa.CBSA = cbsa."CBSA Code"
-                WHERE cbsa."CBSA Name" ILIKE '{st.session_state.selected_cbsa}'
-                AND YEAR::int BETWEEN 2005 AND 2013
-                AND TRY_CAST(HPI AS FLOAT) > 0
-                GROUP BY YEAR::int
-                ORDER BY YEAR::int
-            """)
-
-            # Calculate y-axis range
-            y_min = hpi_by_year["avg_hpi"].min() * 0.95  # 5% below the minimum value
-            y_max = hpi_by_year["avg_hpi"].max() * 1.05  # 5% above the maximum value
-
-            # Find the maximum and minimum points
-            max_point = hpi_by_year.loc[hpi_by_year["avg_hpi"].idxmax()]
-            min_point = hpi_by_year.loc[hpi_by_year["avg_hpi"].idxmin()]
-
-            # Calculate percentage loss
-            percent_loss = (
-                (min_point["avg_hpi"] - max_point["avg_hpi"])
-                / max_point["avg_hpi"]
-                * 100
-            )
-
-            # Create the line chart using Plotly
-            fig = px.line(
-                hpi_by_year,
-                x="year",
-                y="avg_hpi",
-                title=f"Average HPI for {st.session_state.selected_cbsa}",
-            )
-
-            # Add vertical line and annotation
-            fig.add_shape(
-                type="line",
-                x0=max_point["year"],
-                y0=max_point["avg_hpi"],
-                x1=max_point["year"],
-                y1=min_point["avg_hpi"],
-                line=dict(color="red", width=2, dash="dash"),
-            )
-
-            fig.add_annotation(
-                x=max_point["year"],
-                y=min_point["avg_hpi"],  # Position at the bottom of the line
-                text=f"{percent_loss:.1f}% loss",
-                showarrow=True,
-                arrowhead=2,
-                arrowsize=1,
-                arrowwidth=2,
-                arrowcolor="red",
-                ax=40,
-                ay=-40,  # Adjust this value to move the annotation up or down
-                yanchor="top",  # Anchor the text to the top so it appears below the arrow
-            )
-
-            # Update the layout to set the y-axis range
-            fig.update_layout(
-                yaxis_range=[y_min, y_max],
-                xaxis_title="Year",
-                yaxis_title="Average HPI",
-            )
+            fig = get_line_fig(st.session_state.selected_cbsa)
 
             # Display the chart
-            st.plotly_chart(fig, use_container_width=True)
+            if fig is None:
+                # e.g. San Juan PR has no zip-level HPI to chart
+                st.info("No zip-level HPI data is available for this CBSA.")
+            else:
+                st.plotly_chart(fig, use_container_width=True)
 
         with col2:
             # plotting a map with plotly for each using fips + loss from HPI Max to HPI Min
+            if out_df.empty:
+                # some CBSAs have no tract-level HPI, so there is nothing to map
+                st.info("No tract-level HPI data is available for this CBSA.")
+            else:
+                fig = get_map_fig(st.session_state.selected_cbsa)
 
-            # set center lat and lon to the mean of the latitude and longitude columns
-            center_lat = out_df["latitude"].mean()
-            center_lon = out_df["longitude"].mean()
-
-            fig = choropleth_mapbox(
-                out_df,
-                geojson=geojson_counties,
-                locations="fips",
-                color="hpi_loss",
-                color_continuous_scale="RdYlGn",
-                range_color=(-0.5, 0),  # Adjust this range based on your data
-                mapbox_style="carto-positron",
-                zoom=8,
-                opacity=0.7,
-                labels={"hpi_loss": "HPI Loss"},
-            )
-            fig.update_layout(
-                margin={"r": 0, "t": 0, "l": 0, "b": 0},
-                mapbox=dict(
-                    bearing=0,
-                    center=dict(lat=center_lat, lon=center_lon),
-                    pitch=0,
-                    zoom=7,  # Increased from 2 to 7 for a closer default zoom
-                ),
-            )
+                st.plotly_chart(fig, use_container_width=True)
 
-            st.plotly_chart(fig, use_container_width=True)
-
-            # Calculate total population for the CBSA
-            total_population = out_df["population"].sum()
+            # key statistics computed alongside out_df
+            _, _, total_population, avg_hpi_loss, min_year, max_year = cbsa_stats
 
             # Format the population with commas for readability
             formatted_population = f"{total_population:,}"
 
             # Make a dynamic text box with a few bullet points saying the min and max year and the loss from max hpi to min hpi
-            min_year = out_df["min_year"].min()
-            max_year = out_df["max_year"].max()
-            avg_hpi_loss = out_df["hpi_loss"].mean()
+            # the aggregates are missing when the CBSA has no tracts
+            formatted_min_year = "n/a" if pd.isna(min_year) else min_year
+            formatted_max_year = "n/a" if pd.isna(max_year) else max_year
+            formatted_hpi_loss = (
+                "n/a" if pd.isna(avg_hpi_loss) else f"{avg_hpi_loss:.2%}"
+            )
 
             st.markdown(f"""
             ### Key Statistics for {st.session_state.selected_cbsa}
             
             - **Total Metro Area Population:** {formatted_population}
-            - **Minimum HPI Year:** {min_year}
-            - **Maximum HPI Year:** {max_year}
-            - **Average HPI Loss:** {avg_hpi_loss:.2%}
+            - **Minimum HPI Year:** {formatted_min_year}
+            - **Maximum HPI Year:** {formatted_max_year}
+            - **Average HPI Loss:** {formatted_hpi_loss}
             """)
 
     else: